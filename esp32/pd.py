@@ -18,12 +18,25 @@
 ##
 
 import sigrokdecode as srd
-from math import ceil
 
 RX = 0
 TX = 1
 rxtx_channels = ("RX", "TX")
 
+# states of the SlipDecoder
+SLIP_IDLE, SLIP_IN_FRAME, SLIP_ESCAPE = range(3)
+
+# maps the byte following 0xDB to the byte it stands for
+_SLIP_UNESCAPE = bytes.maketrans(b"\xdc\xdd", b"\xc0\xdb")
+
+# byte offsets of the fields of a frame. The fields before OFFSET_DATA form
+# the fixed size frame header.
+OFFSET_DIR = 0
+OFFSET_CMD = 1
+OFFSET_SIZE = 2
+OFFSET_CHECKSUM = 4
+OFFSET_DATA = 8
+
 commandTable = {
     0x02: {
         "Name": "FLASH_BEGIN",
@@ -137,46 +150,86 @@ commandTable = {
 }
 
 
-class No_more_data(Exception):
-    """This exception is a signal that we should stop parsing an ADU as there
-    is no more data to parse."""
+def _buildCmdTable():
+    """Expand commandTable into a list indexed by the command byte. The
+    entries carry the prebuilt annotation messages for the command and
+    for the data of its frames."""
+    table = [None] * 256
+    for value, cmd in commandTable.items():
+        table[value] = dict(
+            cmd,
+            Annotation=["CMD: " + cmd["Name"], cmd["Name"]],
+            DataAnnotation=["Data: " + cmd["Input"], "Data"],
+        )
+    return tuple(table)
+
+
+_CMD_TABLE = _buildCmdTable()
 
-    pass
+# annotation messages of the direction byte
+_DIR_ANNOTATIONS = {
+    0x00: ["DIR: REQ", "REQ"],
+    0x01: ["DIR: RES", "RES"],
+}
 
 
 class SlipDecoder:
     """Decoder for the SLIP protocol, used to encapsulate the messages"""
 
+    __slots__ = ("slipStatus", "slipEscStart")
+
     def __init__(self):
-        self.slipStatus = "idle"
+        self.slipStatus = SLIP_IDLE
         self.slipEscStart = 0
 
     def decode(self, ss, es, value):
-        if self.slipStatus == "idle":
-            if value == 0xC0:
-                self.onFrameStart(ss, es)
-                self.slipStatus = "in_frame"
-            else:
-                self.onError(ss, es, "Unexpected value: 0x%02x" % value)
-        elif self.slipStatus == "in_frame":
-            if value == 0xC0:
-                self.onFrameEnd(ss, es)
-                self.slipStatus = "idle"
-            elif value == 0xDB:
-                self.slipStatus = "escape"
-                self.slipEscStart = ss
-            else:
-                self.onData(ss, es, value)
-        elif self.slipStatus == "escape":
-            if value == 0xDC:
-                self.onData(self.slipEscStart, es, 0xC0)
-            elif value == 0xDD:
-                self.onData(self.slipEscStart, es, 0xDB)
-            else:
-                self.onError(
-                    self.slipEscStart, es, "Unexpected escape value: 0x%02x" % value
-                )
-            self.slipStatus = "in_frame"
+        if value > 0xFF:
+            # UART frames can have up to 9 data bits, the table covers bytes
+            self.onError(ss, es, "Unexpected value: 0x%02x" % value)
+            return
+        self._SLIP_TABLE[self.slipStatus][value](self, ss, es, value)
+
+    def _slipFrameStart(self, ss, es, value):
+        self.onFrameStart(ss, es)
+        self.slipStatus = SLIP_IN_FRAME
+
+    def _slipUnexpected(self, ss, es, value):
+        self.onError(ss, es, "Unexpected value: 0x%02x" % value)
+
+    def _slipFrameEnd(self, ss, es, value):
+        self.onFrameEnd(ss, es)
+        self.slipStatus = SLIP_IDLE
+
+    def _slipEscape(self, ss, es, value):
+        self.slipStatus = SLIP_ESCAPE
+        self.slipEscStart = ss
+
+    def _slipData(self, ss, es, value):
+        self.onData(ss, es, value)
+
+    def _slipEscaped(self, ss, es, value):
+        self.onData(self.slipEscStart, es, _SLIP_UNESCAPE[value])
+        self.slipStatus = SLIP_IN_FRAME
+
+    def _slipUnexpectedEscape(self, ss, es, value):
+        self.onError(self.slipEscStart, es, "Unexpected escape value: 0x%02x" % value)
+        self.slipStatus = SLIP_IN_FRAME
+
+    # action for each received byte, indexed by [slipStatus][value]
+    _SLIP_TABLE = (
+        # SLIP_IDLE
+        (_slipUnexpected,) * 0xC0 + (_slipFrameStart,) + (_slipUnexpected,) * 0x3F,
+        # SLIP_IN_FRAME
+        (_slipData,) * 0xC0
+        + (_slipFrameEnd,)
+        + (_slipData,) * 0x1A
+        + (_slipEscape,)
+        + (_slipData,) * 0x24,
+        # SLIP_ESCAPE
+        (_slipUnexpectedEscape,) * 0xDC
+        + (_slipEscaped,) * 2
+        + (_slipUnexpectedEscape,) * 0x22,
+    )
 
     def onData(self, ss, es, value):
         pass
@@ -194,108 +247,132 @@ class SlipDecoder:
 class BootloaderProtocolDecoder(SlipDecoder):
     """Decoder for the bootloader protocol"""
 
+    __slots__ = (
+        "_puta",
+        "direction",
+        "_ann_dir",
+        "_ann_cmd",
+        "_ann_size",
+        "_ann_checksum",
+        "_ann_value",
+        "_ann_data",
+        "_ann_error",
+        "offset",
+        "_header",
+        "segmentStart",
+        "lastCmd",
+    )
+
     def __init__(self, decoder, direction):
         super().__init__()
-        self.decoder = decoder
+        self._puta = decoder.puta
         self.direction = direction
-        self.status = "cmd"
-        self.lastStatus = ""
-        pass
+        self._ann_dir = direction + "-dir"
+        self._ann_cmd = direction + "-cmd"
+        self._ann_size = direction + "-size"
+        self._ann_checksum = direction + "-checksum"
+        self._ann_value = direction + "-value"
+        self._ann_data = direction + "-data"
+        self._ann_error = direction + "-error"
+        # offset of the next byte in the frame
+        self.offset = OFFSET_DIR
+        self._header = bytearray(OFFSET_DATA)
 
     def onData(self, ss, es, value):
-        if self.status != self.lastStatus:
-            self.segmentStart = ss
-            self.count = 0
-            self.acc = 0
-            self.lastStatus = self.status
+        offset = self.offset
+        if offset > OFFSET_DATA:
+            # the payload is annotated as a whole at the end of the frame
+            return
+        if offset < OFFSET_DATA:
+            self._header[offset] = value
+        self.offset = offset + 1
+        self._PROGRAM[offset](self, ss, es, value)
+
+    def _h_dir(self, ss, es, value):
+        message = _DIR_ANNOTATIONS.get(value)
+        if message is None:
+            self._puta(
+                ss,
+                es,
+                self._ann_error,
+                ["Invalid direction: 0x%02x" % value],
+            )
+            return
+        self._puta(ss, es, self._ann_dir, message)
+
+    def _h_cmd(self, ss, es, value):
+        cmd = _CMD_TABLE[value]
+        if cmd is not None:
+            self.lastCmd = cmd
+            self._puta(ss, es, self._ann_cmd, cmd["Annotation"])
         else:
-            self.count = self.count + 1
-
-        if self.status == "dir":
-            self.status = "cmd"
-            if value == 0x00:
-                str = "REQ"
-            elif value == 0x01:
-                str = "RES"
-            else:
-                self.decoder.puta(
-                    ss,
-                    es,
-                    self.direction + "-error",
-                    "Invalid direction: 0x%02x" % value,
-                )
-                return
-            self.decoder.puta(ss, es, self.direction + "-dir", ["DIR: " + str, str])
-        elif self.status == "cmd":
-            self.status = "size"
-            if value in commandTable:
-                cmd = commandTable[value]
-                self.lastCmd = cmd
-                self.decoder.puta(
-                    ss,
-                    es,
-                    self.direction + "-cmd",
-                    [
-                        "CMD: " + cmd["Name"],
-                        cmd["Name"],
-                    ],
-                )
-            else:
-                self.decoder.puta(
-                    ss,
-                    es,
-                    self.direction + "-error",
-                    "Invalid command: 0x%02x" % value,
-                )
-        elif self.status == "size":
-            self.acc = self.acc + (value << (8 * self.count))
-            if self.count == 1:
-                self.status = "checksum"
-                self.decoder.puta(
-                    self.segmentStart,
-                    es,
-                    self.direction + "-size",
-                    ["Size: 0x%04x" % self.acc, "0x%04x" % self.acc],
-                )
-        elif self.status == "checksum":
-            self.acc = self.acc + (value << (8 * self.count))
-            if self.count == 3:
-                self.status = "data"
-                if self.direction == "pm":
-                    self.decoder.puta(
-                        self.segmentStart,
-                        es,
-                        self.direction + "-checksum",
-                        ["Checksum: 0x%08x" % self.acc, "0x%08x" % self.acc],
-                    )
-                else:
-                    self.decoder.puta(
-                        self.segmentStart,
-                        es,
-                        self.direction + "-value",
-                        ["Value: 0x%08x" % self.acc, "0x%08x" % self.acc],
-                    )
+            self._puta(
+                ss,
+                es,
+                self._ann_error,
+                ["Invalid command: 0x%02x" % value],
+            )
+
+    def _h_fieldStart(self, ss, es, value):
+        self.segmentStart = ss
+
+    def _h_fieldByte(self, ss, es, value):
+        pass
+
+    def _h_size(self, ss, es, value):
+        text = "0x%04x" % int.from_bytes(
+            self._header[OFFSET_SIZE:OFFSET_CHECKSUM], "little"
+        )
+        self._puta(self.segmentStart, es, self._ann_size, ["Size: " + text, text])
+
+    def _h_checksum(self, ss, es, value):
+        text = "0x%08x" % int.from_bytes(
+            self._header[OFFSET_CHECKSUM:OFFSET_DATA], "little"
+        )
+        if self.direction == "pm":
+            self._puta(
+                self.segmentStart,
+                es,
+                self._ann_checksum,
+                ["Checksum: " + text, text],
+            )
+        else:
+            self._puta(
+                self.segmentStart,
+                es,
+                self._ann_value,
+                ["Value: " + text, text],
+            )
+
+    # handler for each byte of the frame header and for the first data byte,
+    # indexed by the offset of the byte in the frame
+    _PROGRAM = (
+        _h_dir,
+        _h_cmd,
+        _h_fieldStart,
+        _h_size,
+        _h_fieldStart,
+        _h_fieldByte,
+        _h_fieldByte,
+        _h_checksum,
+        _h_fieldStart,
+    )
 
     def onFrameStart(self, ss, es):
-        self.status = "dir"
-        self.lastStatus = ""
+        self.offset = OFFSET_DIR
         self.lastCmd = None
-        pass
 
     def onFrameEnd(self, ss, es):
-        if self.status == "data":
+        if self.offset >= OFFSET_DATA:
             if self.lastCmd != None:
-                self.decoder.puta(
+                self._puta(
                     self.segmentStart,
                     ss,
-                    self.direction + "-data",
-                    ["Data: " + self.lastCmd["Input"], "Data"],
+                    self._ann_data,
+                    self.lastCmd["DataAnnotation"],
                 )
             else:
-                self.decoder.puta(
-                    self.segmentStart, ss, self.direction + "-data", "Data"
-                )
-        pass
+                self._puta(self.segmentStart, ss, self._ann_data, ["Data"])
 
     def onError(self, ss, es, message):
         pass
@@ -325,6 +402,8 @@ class Decoder(srd.Decoder):
         ("mp-data", "MP Data"),
         ("mp-error", "MP Error"),
     )
+    # annotation number by annotation id, used by puta()
+    _ANN_NUM = {n: i for i, (n, _) in enumerate(annotations)}
     annotation_rows = (
         (
             "pm",
@@ -376,15 +455,17 @@ class Decoder(srd.Decoder):
     def start(self):
         self.out_ann = self.register(srd.OUTPUT_ANN)
 
+        # rxtx of the channel feeding each decoder. Only the indexes are kept,
+        # reset() replaces the decoders themselves.
+        self._pmChannel = rxtx_channels.index(self.options["pm_channel"])
+        self._mpChannel = rxtx_channels.index(self.options["mp_channel"])
+
     def puta(self, start, end, ann_str, message):
         """Put an annotation from start to end, with ann as a
         string. This means you don't have to know the ann's
-        number to write annotations to it."""
-        ann = [s[0] for s in self.annotations].index(ann_str)
-
-        if not isinstance(message, list):
-            message = [message]
-        self.put(start, end, self.out_ann, [ann, message])
+        number to write annotations to it. The message is the list
+        of annotation texts, it may be shared between calls."""
+        self.put(start, end, self.out_ann, [self._ANN_NUM[ann_str], message])
 
     def decode(self, ss, es, data):
         ptype, rxtx, pdata = data
@@ -394,9 +475,9 @@ class Decoder(srd.Decoder):
 
         value, is_valid = pdata
 
-        # Decide what ADU(s) we need this packet to go to.
-        # Note that it's possible to go to both ADUs.
-        if rxtx_channels[rxtx] == self.options["pm_channel"]:
+        # Decide what decoder(s) we need this packet to go to.
+        # Note that it's possible to go to both decoders.
+        if rxtx == self._pmChannel:
             self.pmDecoder.decode(ss, es, value)
-        if rxtx_channels[rxtx] == self.options["mp_channel"]:
+        if rxtx == self._mpChannel:
             self.mpDecoder.decode(ss, es, value)